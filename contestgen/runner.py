@@ -1,19 +1,134 @@
 import argparse
+import asyncio
 import os
+import re
 import shutil
 import sys
+import textwrap
 import threading
-import yaml
-from collections import OrderedDict
-from subprocess import Popen, PIPE
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from subprocess import PIPE
 from contestgen import __version__
-from contestgen.utilities import configure_yaml  # noqa: F401
+from contestgen.utilities import yaml_backend
 from contestgen.utilities.logger import logger, logger_format_fields, setup_logger
-# PyYAML 3.12 compatibility
+# watchdog is optional; without it new files are found by rescanning the tree
 try:
-    from yaml import FullLoader as DefaultLoader
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
 except ImportError:
-    from yaml import Loader as DefaultLoader
+    FileSystemEventHandler = object
+    Observer = None
+
+EXECUTABLE_KEY = re.compile(r'executable\s*:')
+TEST_CASES_INDENT = re.compile(r'^test-cases:[ \t]*\n(?:[ \t]*(?:#.*)?\n)*([ \t]+)\S', re.MULTILINE)
+
+
+recipe_cache = {}
+
+
+def load_recipe(path, stat, text, maxsize=32):
+    """
+    Load a recipe from its contents, caching the result for as long as the file
+    is unchanged. The returned recipe is shared between callers and must be
+    copied before it is modified.
+
+    :param path: path to the recipe
+    :param stat: result of os.stat on the recipe, taken before it was read
+    :param text: contents of the recipe
+    :param maxsize: maximum number of recipes to cache
+    :return: the loaded recipe
+    """
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in recipe_cache:
+        if len(recipe_cache) >= maxsize:
+            del recipe_cache[next(iter(recipe_cache))]
+        recipe_cache[key] = yaml_backend.load(text)
+    return recipe_cache[key]
+
+
+def find_test_cases(text):
+    """
+    Locate the test cases of a raw recipe so new test cases can be appended to
+    it without loading and dumping the whole recipe. This only recognizes the
+    layout written by record_test: plain top-level keys, with test-cases last.
+
+    :param text: contents of the recipe
+    :return: tuple of the top-level executable and the indentation of the test
+             cases, or None if the recipe cannot be appended to
+    """
+    top_level = [line for line in text.splitlines() if line and not line[0].isspace() and line[0] != '#']
+    if len(top_level) < 2 or top_level[-1].rstrip() != 'test-cases:':
+        return None
+
+    executable = [line for line in top_level if EXECUTABLE_KEY.match(line)]
+    if len(executable) != 1:
+        return None
+    try:
+        executable = yaml_backend.load(executable[0])['executable']
+    except yaml_backend.YAMLError:
+        return None
+
+    test_cases = TEST_CASES_INDENT.search(text)
+    if test_cases is None:
+        return None
+    return executable, test_cases.group(1)
+
+
+def test_case_key(test_name):
+    """
+    Get the key the dumper writes for a test case name
+
+    :param test_name: name of the test case
+    :return: the key as written, or None if the dumper does not write it as a
+             single-line key
+    """
+    key = yaml_backend.dump({test_name: None})
+    if key.count('\n') != 1 or not key.endswith(': null\n'):
+        return None
+    return key[:-len(': null\n')]
+
+
+def has_test_case(text, indent, test_name):
+    """
+    Check whether a raw recipe already has a test case of the given name. Keys
+    are matched as the dumper writes them or as the plain name, optionally
+    quoted, and each match is confirmed by loading the key.
+
+    :param text: contents of the recipe
+    :param indent: indentation of the test cases
+    :param test_name: name of the test case; the dumper must write it as a
+                      single-line key
+    :return: True if the test case exists, otherwise False
+    """
+    pattern = r'^{}(?:{}|([\'"]?){}\1)[ \t]*:'.format(re.escape(indent), re.escape(test_case_key(test_name)), re.escape(test_name))
+    for match in re.finditer(pattern, text, re.MULTILINE):
+        try:
+            if test_name in yaml_backend.load(match.group(0).strip() + ' null'):
+                return True
+        except yaml_backend.YAMLError:
+            pass
+    return False
+
+
+def append_test_case(configuration, recipe_text, indent, test_name, test_case):
+    """
+    Append a test case after the existing test cases of a recipe
+
+    :param configuration: path to the recipe
+    :param recipe_text: current contents of the recipe
+    :param indent: indentation of the test cases
+    :param test_name: name of the test case
+    :param test_case: the test case to append
+    """
+    fragment = yaml_backend.dump({test_name: test_case})
+    # scalars keeping trailing newlines make the dumper end the document with
+    # an explicit marker, which would cut the recipe short once indented
+    if fragment.endswith('\n...\n'):
+        fragment = fragment[:-len('...\n')]
+    with open(configuration, 'a') as recipe:
+        if not recipe_text.endswith('\n'):
+            recipe.write('\n')
+        recipe.write(textwrap.indent(fragment, indent))
 
 
 def record_test(configuration, test_name, command):
@@ -25,112 +140,237 @@ def record_test(configuration, test_name, command):
     :param test_name: name to save the test results under
     :return: 0 for success, otherwise return an error message
     """
-    class RecorderPipe(threading.Thread):
+    class CreationRecorder(FileSystemEventHandler):
         """
-        Custom thread with a pipe for intercepting stdin ina  subprocess
+        Filesystem event handler collecting the paths of files created or moved
+        into place while the test runs
         """
         def __init__(self):
             """
-            Initialize the thread
+            Initialize the handler
             """
-            threading.Thread.__init__(self)
-            self.daemon = True
+            super().__init__()
+            self.created = set()
+            self.sentinel = None
+            self.synced = threading.Event()
 
-            self.lines = []
-            self.process = None
-
-            self.rd, self.wd = os.pipe()
-            self.rpipe = os.fdopen(self.rd)
-            self.wpipe = os.fdopen(self.wd, 'w')
+        def on_created(self, event):
+            if event.is_directory:
+                return
+            if self.sentinel is not None and os.path.basename(event.src_path) == self.sentinel:
+                self.synced.set()
+            else:
+                self.created.add(event.src_path)
 
-            self.start()
+        def on_moved(self, event):
+            if not event.is_directory:
+                self.created.add(event.dest_path)
 
-        def fileno(self):
+        def sync(self, timeout=5.0):
             """
-            Returns the file descriptor of the read-end of the pipe
+            Create and remove a sentinel file, waiting until its event has been
+            handled so every earlier event has been seen too
 
-            :return: file descriptor
+            :param timeout: seconds to wait for the sentinel event
+            :return: True if the sentinel was seen, otherwise False
             """
-            return self.rd
+            self.sentinel = '.contestgen-{}.sync'.format(os.getpid())
+            path = os.path.join('.', self.sentinel)
+            try:
+                open(path, 'x').close()
+            except OSError:
+                return False
+            try:
+                return self.synced.wait(timeout)
+            finally:
+                os.remove(path)
 
-        def run(self):
-            """
-            Method for the running thread. Will yield until the external
-            subprocess is hooked in and will continuw while the write-end of the
-            pipe is open and the subprocess is still running.
-            """
-            while self.process is None:
-                pass
-
-            # TODO: potential race condition here? investigate later.
-            while self.wpipe is not None and self.process.poll() is None:
-                s = input()
-                self.wpipe.write(s + '\n')
-                self.wpipe.flush()
-                self.lines.append(s)
-                # TODO: is this necessary? investigate later.
-                self.check()
-
-        def check(self):
-            """
-            Check if the subprocess is opened, and if it is not, cleanup
-            """
-            if self.process.poll() is not None:
-                self.close()
+    def scan(directory):
+        # files are kept as (directory, name) pairs sharing one directory string
+        directory = sys.intern(directory)
+        files = []
+        directories = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    files.append((directory, entry.name))
+                elif entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+        return files, directories
 
-        def close(self):
-            """
-            Close both ends of the pipe and set the write-end to None
-            """
-            self.rpipe.close()
-            self.wpipe.close()
-            self.wpipe = None
+    def get_files(root, parallel_threshold=4):
+        files, directories = scan(root)
 
-    def get_files(root):
-        files = []
-        for el in os.listdir(root):
-            full_path = os.path.join(root, el)
-            if os.path.isfile(full_path):
-                files.append(full_path)
-            else:
-                files.extend(get_files(full_path))
+        # small trees are not worth the thread startup; walk them serially
+        if len(directories) <= parallel_threshold:
+            while directories:
+                found_files, found_directories = scan(directories.pop())
+                files.extend(found_files)
+                directories.extend(found_directories)
+            return files
+
+        # overlap the per-directory I/O waits, which dominate on network mounts
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            pending = set(executor.submit(scan, directory) for directory in directories)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    found_files, found_directories = future.result()
+                    files.extend(found_files)
+                    pending.update(executor.submit(scan, directory) for directory in found_directories)
         return files
 
-    logger.debug('Starting test with command "{}"'.format(command))
-    recorder_pipe = RecorderPipe()
+    async def forward_stdin(writer, recorded, buffer_size=64 * 1024):
+        """
+        Forward stdin to the subprocess until stdin is exhausted, keeping a copy
+        of everything forwarded
+
+        :param writer: stdin stream of the subprocess
+        :param recorded: bytearray to record the forwarded input in
+        :param buffer_size: maximum number of bytes to read at once
+        """
+        loop = asyncio.get_running_loop()
+        stdin = sys.stdin.fileno()
+        chunks = asyncio.Queue()
+
+        def read():
+            data = os.read(stdin, buffer_size)
+            if not data:
+                loop.remove_reader(stdin)
+            chunks.put_nowait(data)
+
+        def read_blocking():
+            while True:
+                data = os.read(stdin, buffer_size)
+                try:
+                    loop.call_soon_threadsafe(chunks.put_nowait, data)
+                except RuntimeError:
+                    return
+                if not data:
+                    return
+
+        # regular files cannot be polled, nor can anything on Windows; read
+        # those from a daemon thread instead
+        try:
+            loop.add_reader(stdin, read)
+            polling = True
+        except (NotImplementedError, PermissionError):
+            polling = False
+            threading.Thread(target=read_blocking, daemon=True).start()
+
+        try:
+            while True:
+                data = await chunks.get()
+                if not data:
+                    break
+                recorded.extend(data)
+                try:
+                    writer.write(data)
+                    await writer.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    # the subprocess closed its stdin; nothing more to forward
+                    break
+        finally:
+            try:
+                if polling:
+                    loop.remove_reader(stdin)
+            finally:
+                if not writer.is_closing():
+                    writer.close()
+
+    async def run(command):
+        """
+        Run the command, forwarding and recording stdin while it runs
+
+        :param command: list of strings forming a complete command to run
+        :return: tuple of the return code, stdin, stdout and stderr
+        """
+        proc = await asyncio.create_subprocess_exec(*command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        recorded = bytearray()
+        forwarder = asyncio.ensure_future(forward_stdin(proc.stdin, recorded))
+        # communicate() closes stdin on Python 3.12+, cutting off the forwarder
+        stdout, stderr, _ = await asyncio.gather(proc.stdout.read(), proc.stderr.read(), proc.wait())
+        forwarder.cancel()
+        try:
+            await forwarder
+        except asyncio.CancelledError:
+            pass
+        return proc.returncode, bytes(recorded), stdout, stderr
+
+    def decode(output):
+        # translate line endings the same way universal_newlines did
+        return output.decode('utf-8', 'replace').replace('\r\n', '\n').replace('\r', '\n')
+
+    logger.debug('Starting test with command "%s"', command)
 
     files = set(get_files('.'))
 
-    proc = Popen(command, stdin=recorder_pipe, stdout=PIPE, stderr=PIPE, universal_newlines=True)
-    recorder_pipe.process = proc
-    stdout, stderr = proc.communicate()
+    observer = None
+    if Observer is not None:
+        creation_recorder = CreationRecorder()
+        # large trees can exhaust the inotify watch or descriptor limits
+        try:
+            observer = Observer()
+            observer.schedule(creation_recorder, '.', recursive=True)
+            observer.start()
+        except OSError:
+            observer = None
+
+    return_code, stdin, stdout, stderr = asyncio.run(run(command))
+    stdin, stdout, stderr = decode(stdin), decode(stdout), decode(stderr)
     logger.debug('Test complete... writing to recipe...')
 
-    new_files = set(get_files('.')) - files
+    if observer is not None:
+        synced = creation_recorder.sync()
+        observer.stop()
+        observer.join()
+    if observer is not None and synced:
+        new_files = set(os.path.split(f) for f in creation_recorder.created if os.path.isfile(f)) - files
+    else:
+        new_files = set(get_files('.')) - files
 
-    if os.path.exists(configuration):
+    appendable = None
+    try:
+        recipe_stat = os.stat(configuration)
+    except FileNotFoundError:
+        recipe_stat = None
+    if recipe_stat is not None:
         with open(configuration, 'r') as recipe:
-            test_matrix = yaml.load(open(configuration, 'r'), Loader=DefaultLoader)
+            recipe_text = recipe.read()
+        # names that are not written as a single-line key need the full load
+        if test_case_key(test_name) is not None:
+            appendable = find_test_cases(recipe_text)
+
+    test_case = {}
+    if appendable is not None:
+        executable, indent = appendable
+        if has_test_case(recipe_text, indent, test_name):
+            return '{} is already a test case! Choose a new name!'.format(test_name)
+        test_matrix = None
+    elif recipe_stat is not None:
+        test_matrix = load_recipe(configuration, recipe_stat, recipe_text)
         if test_name in test_matrix['test-cases']:
             return '{} is already a test case! Choose a new name!'.format(test_name)
-        test_matrix['test-cases'][test_name] = OrderedDict()
-        test_case = test_matrix['test-cases'][test_name]
-        if command[0] != test_matrix['executable']:
-            test_case['executable'] = command[0]
+        # copy only the containers the new test case is added to
+        test_matrix = dict(test_matrix)
+        test_matrix['test-cases'] = dict(test_matrix['test-cases'])
+        executable = test_matrix['executable']
     else:
-        test_matrix = OrderedDict()
-        test_matrix['executable'] = command[0]
-        test_matrix['test-cases'] = OrderedDict()
-        test_matrix['test-cases'][test_name] = OrderedDict()
-        test_case = test_matrix['test-cases'][test_name]
+        test_matrix = {
+            'executable': command[0],
+            'test-cases': {}
+        }
+        executable = command[0]
 
-    test_case['return-code'] = proc.returncode
+    if command[0] != executable:
+        test_case['executable'] = command[0]
+    test_case['return-code'] = return_code
 
     argv = command[1:]
     if argv:
         test_case['argv'] = command[1:]
-    if recorder_pipe.lines:
-        test_case['stdin'] = '\n'.join(recorder_pipe.lines)
+    if stdin:
+        test_case['stdin'] = stdin[:-1] if stdin.endswith('\n') else stdin
     if stdout:
         test_case['stdout'] = stdout
     if stderr:
@@ -138,16 +378,23 @@ def record_test(configuration, test_name, command):
 
     if new_files:
         test_case['ofstreams'] = []
-        for new_file in new_files:
-            dir_name, file_name = os.path.split(new_file)
+        for dir_name, file_name in new_files:
+            new_file = os.path.join(dir_name, file_name)
             base_file = os.path.join(dir_name, 'contest_' + file_name)
-            shutil.move(new_file, base_file)
-            test_case['ofstreams'].append(OrderedDict())
-            test_case['ofstreams'][-1]['base-file'] = base_file
-            test_case['ofstreams'][-1]['test-file'] = new_file
+            # the base file sits next to the new one, so a rename nearly always works
+            try:
+                os.rename(new_file, base_file)
+            except OSError:
+                shutil.move(new_file, base_file)
+            test_case['ofstreams'].append({'base-file': base_file, 'test-file': new_file})
+
+    if test_matrix is None:
+        append_test_case(configuration, recipe_text, indent, test_name, test_case)
+        return 0
 
-    recipe = open(configuration, 'w')
-    yaml.dump(test_matrix, recipe)
+    test_matrix['test-cases'][test_name] = test_case
+    with open(configuration, 'w') as recipe:
+        yaml_backend.dump(test_matrix, recipe)
     return 0
 
 
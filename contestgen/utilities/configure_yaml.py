@@ -1,26 +1,18 @@
+import re
 import yaml
-from collections import OrderedDict
+# prefer the libyaml-backed implementations when available
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper  # noqa: F401
+except ImportError:
+    from yaml import SafeLoader, SafeDumper  # noqa: F401
 
 
-# https://stackoverflow.com/a/16782282
-def represent_ordereddict(dumper, data):
-    value = []
-    for item_key, item_value in data.items():
-        node_key = dumper.represent_data(item_key)
-        node_value = dumper.represent_data(item_value)
-        value.append((node_key, node_value))
-    return yaml.nodes.MappingNode(u'tag:yaml.org,2002:map', value)
-
-
-yaml.add_representer(OrderedDict, represent_ordereddict)
+# https://stackoverflow.com/a/15423007
+line_breaks = re.compile(u"[\u000a\u000d\u001c\u001d\u001e\u0085\u2028\u2029]")
 
 
-# https://stackoverflow.com/a/15423007
 def should_use_block(value):
-    for c in u"\u000a\u000d\u001c\u001d\u001e\u0085\u2028\u2029":
-        if c in value:
-            return True
-    return False
+    return line_breaks.search(value) is not None
 
 
 def my_represent_scalar(self, tag, value, style=None):
@@ -35,4 +27,6 @@ def my_represent_scalar(self, tag, value, style=None):
     return node
 
 
-yaml.representer.BaseRepresenter.represent_scalar = my_represent_scalar
+# only the dumper used for recipes is configured; assigning it once at import
+# leaves every other dumper and the representer registries untouched
+SafeDumper.represent_scalar = my_represent_scalar
@@ -0,0 +1,30 @@
+import yaml
+from contestgen.utilities.configure_yaml import SafeLoader, SafeDumper
+
+
+YAMLError = yaml.YAMLError
+
+
+def load(stream):
+    """Load a single YAML document.
+
+    Arguments:
+        stream (str or file): YAML text or an open file to read it from
+
+    Returns:
+        The loaded document
+    """
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def dump(data, stream=None):
+    """Dump data as a YAML document, keeping the order of mapping keys.
+
+    Arguments:
+        data: the data to dump
+        stream (file): open file to write to; if None the YAML is returned
+
+    Returns:
+        The YAML text if no stream is given, otherwise None
+    """
+    return yaml.dump(data, stream, Dumper=SafeDumper, sort_keys=False)
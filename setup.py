@@ -23,6 +23,9 @@ setup(
     license=about['__license__'],
     url=about['__url__'],
     install_requires=install_requires,
+    extras_require={
+        'watch': ['watchdog']
+    },
     entry_points={
         'console_scripts': [
             'contestgen=contestgen.__main__:main'
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+from contestgen import runner
+from contestgen.utilities import yaml_backend
+
+
+class AppendTestCaseTests(unittest.TestCase):
+    """
+    Tests for appending test cases to an existing recipe
+    """
+    def setUp(self):
+        handle, self.recipe = tempfile.mkstemp(suffix='.yaml')
+        os.close(handle)
+        self.addCleanup(os.remove, self.recipe)
+        self.test_cases = {'one': {'return-code': 0, 'stdout': 'hi\n'}}
+        with open(self.recipe, 'w') as recipe:
+            yaml_backend.dump({'executable': 'echo', 'test-cases': self.test_cases}, recipe)
+
+    def append(self, test_name, test_case):
+        with open(self.recipe, 'r') as recipe:
+            recipe_text = recipe.read()
+        appendable = runner.find_test_cases(recipe_text)
+        self.assertIsNotNone(appendable)
+        self.assertFalse(runner.has_test_case(recipe_text, appendable[1], test_name))
+        runner.append_test_case(self.recipe, recipe_text, appendable[1], test_name, test_case)
+        self.test_cases[test_name] = test_case
+
+    def load(self):
+        with open(self.recipe, 'r') as recipe:
+            return yaml_backend.load(recipe)
+
+    def test_append(self):
+        self.append('two', {'return-code': 1, 'argv': ['a', 'b'], 'stdin': 'x\ny', 'stdout': 'x\ny\n'})
+        self.assertEqual(self.load(), {'executable': 'echo', 'test-cases': self.test_cases})
+
+    def test_append_trailing_newlines(self):
+        self.append('blank', {'return-code': 0, 'stdout': '\n'})
+        self.append('kept', {'return-code': 0, 'stdout': 'x\n\n', 'stderr': 'e'})
+        self.append('last', {'return-code': 0})
+        self.assertEqual(self.load(), {'executable': 'echo', 'test-cases': self.test_cases})
+
+    def test_duplicate_names(self):
+        for test_name in ('café', "'", 'yes', 'a: b'):
+            self.append(test_name, {'return-code': 0})
+            with open(self.recipe, 'r') as recipe:
+                recipe_text = recipe.read()
+            _, indent = runner.find_test_cases(recipe_text)
+            self.assertTrue(runner.has_test_case(recipe_text, indent, test_name))
+        self.assertEqual(self.load(), {'executable': 'echo', 'test-cases': self.test_cases})
+
+
+if __name__ == '__main__':
+    unittest.main()